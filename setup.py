@@ -19,5 +19,10 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    install_requires=["requests", "pydantic"],
+    install_requires=["requests"],
+    extras_require={
+        "speedups": ["ciso8601", "orjson"],
+        "numpy": ["numpy"],
+        "cache": ["requests-cache>=1.0"],
+    },
 )
@@ -1,25 +1,95 @@
+import contextlib
 import json
 import os
+import re
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
 from datetime import datetime
 from typing import List
+from urllib.parse import urlencode
 
 import requests
-from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from requests.cookies import create_cookie, remove_cookie_by_name
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    from ciso8601 import parse_datetime as _parse_iso_datetime
+except ImportError:
+    _parse_iso_datetime = datetime.fromisoformat
 
 TELENET_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.0%z"
+_DATE_FMT = "%Y-%m-%d"
+# fromisoformat before Python 3.11 only accepts 3 or 6 fractional digits
+_ZERO_FRACTION_RE = re.compile(r"\.0+(?=[+-]|$)")
+
+_AUTHORIZE_URL = (
+    "https://login.prd.telenet.be/openid/oauth/authorize?"
+    + urlencode(
+        {
+            "client_id": "ocapi",
+            "response_type": "code",
+            "claims": json.dumps(
+                {
+                    "id_token": {
+                        "http://telenet.be/claims/roles": None,
+                        "http://telenet.be/claims/licenses": None,
+                    }
+                },
+                separators=(",", ":"),
+            ),
+            "lang": "nl",
+        }
+    )
+    + "&state={state}&nonce={nonce}&prompt=login"
+)
+
+# Seconds a response is reused before it is fetched again, Telenet refreshes the telemeter hourly
+USERDETAILS_CACHE_TTL = 30
+TELEMETER_CACHE_TTL = 600
+# Seconds after a login that its saved session cookies are reused, re-saving them keeps the login time
+COOKIE_CACHE_MAX_AGE = 3600
+
+
+def _parse_datetime(value):
+    # '2021-02-19T00:00:00.0+01:00'
+    return _parse_iso_datetime(_ZERO_FRACTION_RE.sub("", value, count=1))
+
+
+_KIB_TO_GIB = 1.0 / (1 << 20)
 
 
 def _kibibyte_to_gibibyte(kib):
-    return kib / (2 ** 20)
+    return kib * _KIB_TO_GIB
 
 
 class UnauthorizedException(Exception):
     pass
 
 
-class UsageDay(BaseModel):
+def _check_status(r, expected):
+    """Raises if the response status differs from the expected one, UnauthorizedException for 401/403"""
+    if r.status_code == expected:
+        return
+    message = f"{r.request.method} {r.url} returned {r.status_code}, expected {expected}: {r.text[:200]}"
+    if r.status_code in (401, 403):
+        raise UnauthorizedException(message)
+    raise requests.HTTPError(message, response=r)
+
+
+@dataclass
+class UsageDay:
     """Represents a day of internet usage"""
 
+    __slots__ = ("date", "peak_usage", "offpeak_usage")
+
     date: datetime
     peak_usage: int
     offpeak_usage: int
@@ -27,10 +97,22 @@ class UsageDay(BaseModel):
     def __str__(self):
         peak_usage_gib = _kibibyte_to_gibibyte(self.peak_usage)
         offpeak_usage_gib = _kibibyte_to_gibibyte(self.offpeak_usage)
-        return f"{self.date.strftime('%Y-%m-%d')}: {peak_usage_gib:4.2f} GiB\t{offpeak_usage_gib:4.2f} GiB"
-
+        return f"{self.date.strftime(_DATE_FMT)}: {peak_usage_gib:4.2f} GiB\t{offpeak_usage_gib:4.2f} GiB"
+
+
+@dataclass
+class TelenetProductUsage:
+    __slots__ = (
+        "product_type",
+        "squeezed",
+        "period_start",
+        "period_end",
+        "included_volume",
+        "peak_usage",
+        "offpeak_usage",
+        "daily_usage",
+    )
 
-class TelenetProductUsage(BaseModel):
     product_type: str
     squeezed: bool
     period_start: datetime
@@ -43,35 +125,53 @@ class TelenetProductUsage(BaseModel):
 
     @classmethod
     def from_json(cls, data: dict):
+        total_usage = data["totalusage"]
         days = [
             UsageDay(
-                date=datetime.strptime(x["date"], TELENET_DATETIME_FORMAT),
+                date=_parse_datetime(x["date"]),
                 peak_usage=x["peak"],
                 offpeak_usage=x["offpeak"],
             )
-            for x in data["totalusage"]["dailyusages"]
+            for x in total_usage["dailyusages"]
         ]
 
         return cls(
             product_type=data["producttype"],
             squeezed=data["squeezed"],
-            period_start=datetime.strptime(
-                data["periodstart"], TELENET_DATETIME_FORMAT
-            ),
-            period_end=datetime.strptime(data["periodend"], TELENET_DATETIME_FORMAT),
+            period_start=_parse_datetime(data["periodstart"]),
+            period_end=_parse_datetime(data["periodend"]),
             included_volume=data["includedvolume"],
-            peak_usage=data["totalusage"]["peak"],
-            offpeak_usage=data["totalusage"]["offpeak"],
+            peak_usage=total_usage["peak"],
+            offpeak_usage=total_usage["offpeak"],
             daily_usage=days,
         )
 
+    def to_numpy(self):
+        """Returns the daily usage as a NumPy structured array with date, peak_usage and offpeak_usage columns"""
+        import numpy as np
+
+        return np.array(
+            [
+                (day.date.date(), day.peak_usage, day.offpeak_usage)
+                for day in self.daily_usage
+            ],
+            dtype=[
+                ("date", "datetime64[D]"),
+                ("peak_usage", np.int64),
+                ("offpeak_usage", np.int64),
+            ],
+        )
+
     def __str__(self):
         peak_usage_gib = _kibibyte_to_gibibyte(self.peak_usage)
         offpeak_usage_gib = _kibibyte_to_gibibyte(self.offpeak_usage)
         return f"Usage for {self.product_type}: {peak_usage_gib:4.2f} GiB peak usage, {offpeak_usage_gib:4.2f} GiB offpeak usage"
 
 
-class Telemeter(BaseModel):
+@dataclass
+class Telemeter:
+    __slots__ = ("period_start", "period_end", "products")
+
     period_start: datetime
     period_end: datetime
     products: List[TelenetProductUsage]
@@ -79,9 +179,8 @@ class Telemeter(BaseModel):
     @classmethod
     def from_json(cls, data: dict):
         for period in data["internetusage"][0]["availableperiods"]:
-            # '2021-02-19T00:00:00.0+01:00'
-            start = datetime.strptime(period["start"], TELENET_DATETIME_FORMAT)
-            end = datetime.strptime(period["end"], TELENET_DATETIME_FORMAT)
+            start = _parse_datetime(period["start"])
+            end = _parse_datetime(period["end"])
             products = [TelenetProductUsage.from_json(x) for x in period["usages"]]
             yield cls(period_start=start, period_end=end, products=products)
 
@@ -93,112 +192,218 @@ class Telemeter(BaseModel):
 
 
 class TelenetSession(object):
-    def __init__(self):
-        self.s = requests.Session()
+    def __init__(self, cache_name=None):
+        """If cache_name is given, telemeter responses are cached in that sqlite database (needs requests-cache)"""
+        if cache_name is None:
+            self.s = requests.Session()
+        else:
+            from requests_cache import CachedSession
+
+            # Cached responses store their request headers, session token included, so keep the file private.
+            # The path is resolved like requests-cache would, so the file made private is the one it uses.
+            cache_name = os.path.abspath(os.path.expanduser(cache_name))
+            if not os.path.splitext(cache_name)[1]:
+                cache_name += ".sqlite"
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            os.close(os.open(cache_name, os.O_WRONLY | os.O_CREAT, 0o600))
+            os.chmod(cache_name, 0o600)
+
+            # Key the cache on the X-TOKEN-XSRF header, and thus on the login. Matching every header would also
+            # key on the Cache-Control header force_refresh adds, so a refresh would not replace the entry.
+            self.s = CachedSession(
+                cache_name,
+                backend="sqlite",
+                expire_after=TELEMETER_CACHE_TTL,
+                allowable_methods=("GET",),
+                match_headers=["X-TOKEN-XSRF"],
+            )
+        # Share one pool per host so the TLS connection survives the whole OAuth flow
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504)
+            ),
+        )
+        self.s.mount("https://api.prd.telenet.be", adapter)
+        self.s.mount("https://login.prd.telenet.be", adapter)
         self.s.headers[
             "User-Agent"
         ] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.182 Safari/537.36"
+        self._cache = {}
+        # Wall clock time of the login the session cookies belong to, if known
+        self._login_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the underlying HTTP session and release its pooled connections"""
+        self.s.close()
+
+    def _uncached(self):
+        """Returns a context manager that bypasses the on-disk cache, if there is one"""
+        if hasattr(self.s, "cache_disabled"):
+            return self.s.cache_disabled()
+        return contextlib.nullcontext()
+
+    def _cached(self, key, ttl, fetch, force_refresh=False):
+        """Returns fetch(force_refresh), reusing its result for ttl seconds while the XSRF token is unchanged"""
+        token = self.s.cookies.get("TOKEN-XSRF")
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if not force_refresh and entry is not None:
+            cached_token, timestamp, value = entry
+            if cached_token == token and now - timestamp < ttl:
+                return value
+
+        try:
+            value = fetch(force_refresh)
+        except UnauthorizedException:
+            self._cache.pop(key, None)
+            raise
+        self._cache[key] = (token, now, value)
+        return value
+
+    def save_cookies(self, path):
+        """Writes the session cookies to path so a later session can skip the login"""
+        cookies = [
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "expires": cookie.expires,
+                "secure": cookie.secure,
+            }
+            for cookie in self.s.cookies
+        ]
+
+        # Write to a fresh private (0600) temporary file first so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                timestamp = self._login_time if self._login_time is not None else time.time()
+                json.dump({"timestamp": timestamp, "cookies": cookies}, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def load_cookies(self, path, max_age=COOKIE_CACHE_MAX_AGE):
+        """Loads cookies written by save_cookies, returns False if the file is invalid or its login is too old"""
+        try:
+            with open(path, "rb") as f:
+                data = _json_loads(f.read())
+            timestamp = data["timestamp"]
+            if time.time() - timestamp > max_age:
+                return False
+            # Build every cookie first so a malformed file leaves the jar untouched
+            cookies = [create_cookie(**cookie) for cookie in data["cookies"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        for cookie in cookies:
+            self.s.cookies.set_cookie(cookie)
+        self._login_time = timestamp
+        if "TOKEN-XSRF" in self.s.cookies:
+            self.s.headers["X-TOKEN-XSRF"] = self.s.cookies["TOKEN-XSRF"]
+        return True
 
     def login(self, username, password):
-        # Get OAuth2 state / nonce
-        r = self.s.get(
-            "https://api.prd.telenet.be/ocapi/oauth/userdetails",
-            headers={
-                "x-alt-referer": "https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice"
-            },
+        with self._uncached():
+            # Get OAuth2 state / nonce
+            r = self._request_userdetails()
+            if (
+                r.status_code == 401
+                and "TOKEN-XSRF" in self.s.cookies
+                and self.s.headers.get("X-TOKEN-XSRF") != self.s.cookies["TOKEN-XSRF"]
+            ):
+                # The session cookies may still be valid, only the XSRF header is missing
+                r.close()
+                self.s.headers["X-TOKEN-XSRF"] = self.s.cookies["TOKEN-XSRF"]
+                r = self._request_userdetails()
+            with r:
+                if r.status_code == 200:
+                    # Session is still logged in
+                    return
+                _check_status(r, 401)
+                state, nonce = r.text.split(",", maxsplit=2)
+
+            # Log in
+            self.s.get(_AUTHORIZE_URL.format(state=state, nonce=nonce)).close()
+            # Drop any stale token so only one issued by this login passes the check below
+            remove_cookie_by_name(self.s.cookies, "TOKEN-XSRF")
+            self.s.headers.pop("X-TOKEN-XSRF", None)
+            with self.s.post(
+                "https://login.prd.telenet.be/openid/login.do",
+                data={
+                    "j_username": username,
+                    "j_password": password,
+                    "rememberme": True,
+                },
+            ) as r:
+                _check_status(r, 200)
+
+            # login.do answers 200 either way, only a successful login sets the XSRF token
+            if "TOKEN-XSRF" not in self.s.cookies:
+                raise UnauthorizedException("Login failed, no XSRF token was issued")
+            self.s.headers["X-TOKEN-XSRF"] = self.s.cookies["TOKEN-XSRF"]
+            self._login_time = time.time()
+
+    def userdetails(self, force_refresh=False):
+        return self._cached(
+            "userdetails",
+            USERDETAILS_CACHE_TTL,
+            self._fetch_userdetails,
+            force_refresh,
         )
-        assert r.status_code == 401
-        state, nonce = r.text.split(",", maxsplit=2)
 
-        # Log in
-        self.s.get(
-            f"https://login.prd.telenet.be/openid/oauth/authorize?client_id=ocapi&response_type=code&claims=%7B%22id_token%22%3A%7B%22http%3A%2F%2Ftelenet.be%2Fclaims%2Froles%22%3Anull%2C%22http%3A%2F%2Ftelenet.be%2Fclaims%2Flicenses%22%3Anull%7D%7D&lang=nl&state={state}&nonce={nonce}&prompt=login"
-        )
-        r = self.s.post(
-            "https://login.prd.telenet.be/openid/login.do",
-            data={
-                "j_username": username,
-                "j_password": password,
-                "rememberme": True,
-            },
-        )
-        assert r.status_code == 200
+    def _request_userdetails(self):
+        with self._uncached():
+            return self.s.get(
+                "https://api.prd.telenet.be/ocapi/oauth/userdetails",
+                headers={
+                    "x-alt-referer": "https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice",
+                },
+            )
 
-        self.s.headers["X-TOKEN-XSRF"] = self.s.cookies["TOKEN-XSRF"]
+    def _fetch_userdetails(self, force_refresh=False):
+        # userdetails never goes through the on-disk cache, so there is nothing to refresh there
+        with self._request_userdetails() as r:
+            _check_status(r, 200)
+            return _json_loads(r.content)
 
-        r = self.s.get(
-            "https://api.prd.telenet.be/ocapi/oauth/userdetails",
-            headers={
-                "x-alt-referer": "https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice",
-            },
-        )
-        assert r.status_code == 200
-
-    def userdetails(self):
-        r = self.s.get(
-            "https://api.prd.telenet.be/ocapi/oauth/userdetails",
-            headers={
-                "x-alt-referer": "https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice",
-            },
+    def telemeter(self, force_refresh=False):
+        return self._cached(
+            "telemeter", TELEMETER_CACHE_TTL, self._fetch_telemeter, force_refresh
         )
-        assert r.status_code == 200
-        return r.json()
 
-    def telemeter(self):
-        r = self.s.get(
-            "https://api.prd.telenet.be/ocapi/public/?p=internetusage,internetusagereminder",
+    def _fetch_telemeter(self, force_refresh=False):
+        kwargs = {}
+        if force_refresh and hasattr(self.s, "cache_disabled"):
+            # Fetch anew and overwrite the on-disk entry, rather than only skipping it
+            kwargs["force_refresh"] = True
+        with self.s.get(
+            "https://api.prd.telenet.be/ocapi/public/?p=internetusage",
             headers={
                 "x-alt-referer": "https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice",
             },
-        )
-        assert r.status_code == 200
-        return next(Telemeter.from_json(r.json()))
-
-
-def get_telemeter_json(cookies):
-    """Returns a tuple containing the Telemeter JSON and the max usage/month in GB"""
-
-    # Firefox wraps JSON in HTML so just make a simple request with Selenium's cookies
-    headers = {"User-Agent": USER_AGENT}
-
-    # Get JSON endpoint again with raw request
-    r = requests.get(
-        "https://api.prd.telenet.be/ocapi/public/?p=internetusage",
-        cookies=cookies,
-        headers=headers,
-    )
-
-    if 200 > r.status_code > 300:
-        raise UnauthorizedException(f"Request returned {r.status_code}")
-
-    meter_json = json.loads(r.text)
-
-    # Get max usage
-    spec_url = meter_json["internetusage"][0]["availableperiods"][0]["usages"][0][
-        "specurl"
-    ]
-    r = requests.get(spec_url, cookies=cookies, headers=headers)
-
-    # parse JSON
-    spec_json = json.loads(r.text)
-    service_limit = int(
-        spec_json["product"]["characteristics"]["service_category_limit"]["value"]
-    )
-    service_limit_unit = spec_json["product"]["characteristics"][
-        "service_category_limit"
-    ]["unit"]
-
-    if service_limit_unit == "MB":
-        service_limit /= 1000
-    elif service_limit_unit == "TB":
-        service_limit *= 1000
-
-    return (meter_json, service_limit)
+            **kwargs,
+        ) as r:
+            _check_status(r, 200)
+            data = _json_loads(r.content)
+        return next(Telemeter.from_json(data))
 
 
 def _main():
     from getpass import getpass
     import argparse
+    import importlib.util
 
     parser = argparse.ArgumentParser(
         prog="Telenet Telemeter parser",
@@ -213,16 +418,42 @@ def _main():
         action="store_true",
         help="Display usage per-day",
     )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        default=False,
+        action="store_true",
+        help="Always fetch fresh data instead of using the on-disk cache",
+    )
+    parser.add_argument(
+        "--cookie-file",
+        dest="cookie_file",
+        default="~/.telemeter_cookies.json",
+        help="File the session cookies are saved to between runs",
+    )
     args = parser.parse_args()
 
+    cache_name = None
+    if not args.no_cache and importlib.util.find_spec("requests_cache") is not None:
+        cache_name = os.path.expanduser("~/.telemeter_cache")
+    cookie_file = os.path.expanduser(args.cookie_file)
+
     # Attempt to get the API data
     print("Fetching Telemeter data")
-    username = os.environ.get("TELENET_USERNAME") or input("Email: ")
-    password = os.environ.get("TELENET_PASSWORD") or getpass("Password: ")
-
-    session = TelenetSession()
-    session.login(username, password)
-    telemeter = session.telemeter()
+    with TelenetSession(cache_name) as session:
+        telemeter = None
+        # Saved cookies skip the login entirely while they are still valid
+        if session.load_cookies(cookie_file):
+            try:
+                telemeter = session.telemeter()
+            except UnauthorizedException:
+                pass
+
+        if telemeter is None:
+            username = os.environ.get("TELENET_USERNAME") or input("Email: ")
+            password = os.environ.get("TELENET_PASSWORD") or getpass("Password: ")
+            session.login(username, password)
+            telemeter = session.telemeter()
     print(telemeter)
 
     if args.display_days:
@@ -232,6 +463,12 @@ def _main():
             for day in product.daily_usage:
                 print("\t", day)
 
+    # Failing to save the cookies only costs a login on the next run
+    try:
+        session.save_cookies(cookie_file)
+    except OSError as e:
+        print(f"Warning: could not save cookies to {cookie_file}: {e}", file=sys.stderr)
+
 
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,219 @@
+import io
+import json
+import os
+import stat
+from http.client import HTTPMessage
+from types import SimpleNamespace
+
+import pytest
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+import telemeter
+
+PASSWORD = "secret"
+TOKEN = "NEW"
+
+
+def _telemeter_json(product_type):
+    day = "2021-02-19T00:00:00.0+01:00"
+    return {
+        "internetusage": [
+            {
+                "availableperiods": [
+                    {
+                        "start": day,
+                        "end": day,
+                        "usages": [
+                            {
+                                "producttype": product_type,
+                                "squeezed": False,
+                                "periodstart": day,
+                                "periodend": day,
+                                "includedvolume": 1,
+                                "totalusage": {
+                                    "peak": 1,
+                                    "offpeak": 1,
+                                    "dailyusages": [{"date": day, "peak": 1, "offpeak": 1}],
+                                },
+                            }
+                        ],
+                    }
+                ]
+            }
+        ]
+    }
+
+
+class FakeTelenet(HTTPAdapter):
+    """Transport adapter answering like the Telenet endpoints TelenetSession talks to"""
+
+    def __init__(self):
+        super().__init__()
+        self.product_type = "internet"
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        authorized = request.headers.get("X-TOKEN-XSRF") == TOKEN
+        status, body, cookie = 200, b"{}", None
+        if "/oauth/userdetails" in request.url:
+            if not authorized:
+                status, body = 401, b"state,nonce"
+        elif "/login.do" in request.url:
+            if f"j_password={PASSWORD}" in request.body:
+                cookie = f"TOKEN-XSRF={TOKEN}; Domain=.telenet.be; Path=/"
+        elif "/ocapi/public/" in request.url:
+            if authorized:
+                body = json.dumps(_telemeter_json(self.product_type)).encode()
+            else:
+                status = 401
+
+        headers = HTTPMessage()
+        headers["Content-Type"] = "application/json"
+        if cookie is not None:
+            headers["Set-Cookie"] = cookie
+        raw = HTTPResponse(
+            body=io.BytesIO(body),
+            headers=dict(headers),
+            status=status,
+            preload_content=False,
+        )
+        # requests reads Set-Cookie from the underlying http.client response
+        raw._original_response = SimpleNamespace(msg=headers, isclosed=lambda: True)
+        return self.build_response(request, raw)
+
+
+def _session(cache_name=None):
+    session = telemeter.TelenetSession(cache_name)
+    fake = FakeTelenet()
+    session.s.mount("https://api.prd.telenet.be", fake)
+    session.s.mount("https://login.prd.telenet.be", fake)
+    return session, fake
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_cookies_round_trip(tmp_path):
+    path = tmp_path / "cookies.json"
+    session, _ = _session()
+    session.login("user", PASSWORD)
+    session.save_cookies(path)
+    assert _mode(path) == 0o600
+
+    restored, fake = _session()
+    assert restored.load_cookies(path)
+    assert restored.s.headers["X-TOKEN-XSRF"] == TOKEN
+    assert restored.telemeter().products[0].product_type == "internet"
+    assert len(fake.requests) == 1
+
+
+def test_save_cookies_ignores_leftover_temporary_file(tmp_path):
+    path = tmp_path / "cookies.json"
+    leftover = tmp_path / "cookies.json.tmp"
+    leftover.write_text("")
+    leftover.chmod(0o644)
+
+    session, _ = _session()
+    session.login("user", PASSWORD)
+    session.save_cookies(path)
+    assert _mode(path) == 0o600
+
+
+def test_load_cookies_rejects_old_login(tmp_path):
+    path = tmp_path / "cookies.json"
+    session, _ = _session()
+    session.login("user", PASSWORD)
+    session.save_cookies(path)
+
+    # Re-saving keeps the time of the original login
+    restored, _ = _session()
+    assert restored.load_cookies(path)
+    restored.save_cookies(path)
+    data = json.loads(path.read_text())
+    assert data["timestamp"] == session._login_time
+
+    data["timestamp"] -= telemeter.COOKIE_CACHE_MAX_AGE + 1
+    path.write_text(json.dumps(data))
+    assert not _session()[0].load_cookies(path)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "[]",
+        '{"cookies": []}',
+        '{"timestamp": "now", "cookies": []}',
+        '{"timestamp": 1e12, "cookies": 5}',
+        '{"timestamp": 1e12, "cookies": [{"name": "a", "value": "b", "bogus": 1}]}',
+    ],
+)
+def test_load_cookies_rejects_malformed_file(tmp_path, content):
+    path = tmp_path / "cookies.json"
+    path.write_text(content)
+    session, _ = _session()
+    assert not session.load_cookies(path)
+    assert len(session.s.cookies) == 0
+
+
+def test_load_cookies_missing_file(tmp_path):
+    assert not _session()[0].load_cookies(tmp_path / "missing.json")
+
+
+def test_force_refresh_skips_memory_cache():
+    session, fake = _session()
+    session.login("user", PASSWORD)
+    session.telemeter()
+    fake.product_type = "refreshed"
+    assert session.telemeter().products[0].product_type == "internet"
+    assert session.telemeter(force_refresh=True).products[0].product_type == "refreshed"
+
+
+def test_force_refresh_replaces_disk_cache_entry(tmp_path):
+    pytest.importorskip("requests_cache")
+    cache_name = str(tmp_path / "cache")
+    session, fake = _session(cache_name)
+    session.login("user", PASSWORD)
+    session.telemeter()
+
+    fake.product_type = "refreshed"
+    assert session.telemeter(force_refresh=True).products[0].product_type == "refreshed"
+
+    # A new session with the same token is served the refreshed entry from disk
+    restored, fake = _session(cache_name)
+    restored.s.headers["X-TOKEN-XSRF"] = TOKEN
+    assert restored.telemeter().products[0].product_type == "refreshed"
+    assert fake.requests == []
+
+
+def test_disk_cache_is_private(tmp_path, monkeypatch):
+    pytest.importorskip("requests_cache")
+    monkeypatch.setenv("HOME", str(tmp_path))
+    session, _ = _session("~/new/cache")
+    session.login("user", PASSWORD)
+    session.telemeter()
+    assert _mode(tmp_path / "new" / "cache.sqlite") == 0o600
+
+
+def _stale_session():
+    session, fake = _session()
+    session.s.cookies.set("TOKEN-XSRF", "OLD", domain=".telenet.be", path="/")
+    session.s.headers["X-TOKEN-XSRF"] = "OLD"
+    return session, fake
+
+
+def test_login_rejects_wrong_password_with_stale_token():
+    session, _ = _stale_session()
+    with pytest.raises(telemeter.UnauthorizedException):
+        session.login("user", "wrong")
+    assert "X-TOKEN-XSRF" not in session.s.headers
+
+
+def test_login_replaces_stale_token():
+    session, _ = _stale_session()
+    session.login("user", PASSWORD)
+    assert session.s.headers["X-TOKEN-XSRF"] == TOKEN
+    assert session.telemeter().products[0].product_type == "internet"